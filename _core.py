@@ -0,0 +1,52 @@
+from typing import Callable, List, Any, Iterable
+
+
+def ingest_batch(records: Iterable[Any],
+                 parsers: List[Callable[[Any], Any]],
+                 uniq_key: Callable[[list], tuple] | None,
+                 seen: Any,
+                 skip_duplicates: bool,
+                 out_rows: List[list],
+                 bad_rows: List[tuple[Exception, Any]] = None,
+                 skipped_rows: List[list] = None) -> None:
+    """
+    Parse a batch of raw records and append the accepted rows to `out_rows`.
+
+    This is the hot path of inserting, and it is kept free of attribute lookups so that it can
+    also be compiled with Cython in pure Python mode (`cythonize -i _core.py`).
+
+    Args:
+        records: The raw records (dict-like) to be parsed.
+        parsers: The parsers of fields, in column order.
+        uniq_key: A callable that gets the unique-key tuple from the parsed values, or `None` if
+                  no unique key is specified.
+        seen: The set (or set-like container) of unique-key tuples of records accepted so far.
+              It is updated in place.
+        skip_duplicates: Skip the records whose unique-key tuple is already in `seen` if True.
+        out_rows: The list that accepted rows, as `[value_1, ..., value_n]`, are appended to.
+        bad_rows: The list that `(exception, record)` of records failed to be parsed (or checked for
+                  duplicates) are appended to.
+                  The failed record is simply skipped if `None` is set.
+        skipped_rows: The list that rows skipped as duplicates are appended to, so that they can be
+                      written instead if the accepted row with the same unique key fails to be stored.
+    """
+    track_keys = uniq_key is not None
+    append_row = out_rows.append
+    for record in records:
+        try:
+            values = [parser(record) for parser in parsers]
+            # Unhashable unique-key values fail here as well, and are reported like parsing errors.
+            if track_keys:
+                key = uniq_key(values)
+                if key in seen:
+                    if skip_duplicates:
+                        if skipped_rows is not None:
+                            skipped_rows.append(values)
+                        continue
+                else:
+                    seen.add(key)
+        except Exception as e:
+            if bad_rows is not None:
+                bad_rows.append((e, record))
+            continue
+        append_row(values)
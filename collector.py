@@ -1,12 +1,132 @@
+import csv
+import io
+import itertools
+import operator
 import os
-import sys
-from typing import Callable, List, Dict, Any, Type, Iterable
-import threading
+import weakref
+from typing import Callable, List, Dict, Any, Iterable, Iterator, TextIO
 from fields import *
+from _core import ingest_batch
 import sqlite3
-import time
-import hashlib
-import random
+
+try:
+    from rbloom import Bloom
+except ImportError:
+    Bloom = None
+
+
+def _with_ids(rows: List[list], next_id: int) -> List[tuple]:
+    """ Prepend consecutive `__id` values starting from `next_id` to the rows. """
+    return [(next_id + i, *row) for i, row in enumerate(rows)]
+
+
+def _insert_row(connection: sqlite3.Connection, insert_sql: str, row: list,
+                legacy_next_id: List[int] | None) -> None:
+    """ Insert a single row, binding the next `__id` explicitly for a table created by previous versions. """
+    if legacy_next_id is None:
+        connection.execute(insert_sql, row)
+    else:
+        connection.execute(insert_sql, (legacy_next_id[0], *row))
+        legacy_next_id[0] += 1
+
+
+def _write_rows(connection: sqlite3.Connection, insert_sql: str, pending: List[list], skipped: List[list],
+                legacy_next_id: List[int] | None, uniq_key: Callable[[list], tuple] | None,
+                error_handler: Callable[[Exception, Any], Any] | None) -> set[tuple]:
+    """
+    Write the pending rows into SQLite in a single transaction. If the batch fails, it is rolled back
+    and the rows are written one by one instead, so that only the problematic rows are passed to
+    `error_handler` (or skipped); a row skipped as a duplicate of a failed one is written instead of it.
+    Returns the unique keys of rows that failed to be stored.
+    """
+    failed_keys = set()
+    if len(pending) == 0:
+        return failed_keys
+    try:
+        with connection:
+            if legacy_next_id is None:
+                connection.executemany(insert_sql, pending)
+            else:
+                connection.executemany(insert_sql, _with_ids(pending, legacy_next_id[0]))
+                legacy_next_id[0] += len(pending)
+        return failed_keys
+    except sqlite3.Error:
+        pass
+    with connection:
+        for row in pending:
+            try:
+                _insert_row(connection, insert_sql, row, legacy_next_id)
+            except sqlite3.Error as e:
+                if uniq_key is not None:
+                    failed_keys.add(uniq_key(row))
+                if error_handler is not None:
+                    error_handler(e, row)
+        for row in skipped:
+            key = uniq_key(row)
+            if key not in failed_keys:
+                continue
+            try:
+                _insert_row(connection, insert_sql, row, legacy_next_id)
+                failed_keys.discard(key)
+            except sqlite3.Error as e:
+                if error_handler is not None:
+                    error_handler(e, row)
+    return failed_keys
+
+
+def _release_sqlite(connection: sqlite3.Connection, pending: List[list], skipped: List[list], insert_sql: str,
+                    deferred_indexes: List[str], legacy_next_id: List[int] | None,
+                    uniq_key: Callable[[list], tuple] | None,
+                    error_handler: Callable[[Exception, Any], Any] | None) -> None:
+    """
+    Write the pending records, create the deferred indexes, then commit and close the sqlite connection.
+    It does not reference the collector itself, so that it can be registered by `weakref.finalize`.
+    """
+    try:
+        _write_rows(connection, insert_sql, pending, skipped, legacy_next_id, uniq_key, error_handler)
+        pending.clear()
+        skipped.clear()
+        for stmt_index in deferred_indexes:
+            connection.execute(stmt_index)
+        deferred_indexes.clear()
+    finally:
+        try:
+            connection.commit()
+        finally:
+            connection.close()
+
+
+class _BloomKeySet(object):
+    """
+    Set-like container of unique-key tuples for duplicate detection on very large collections. A bloom filter
+    answers most lookups; only when it reports a possible hit, the key is checked exactly against the keys
+    not flushed yet and the (indexed) records in SQLite backend.
+    """
+
+    def __init__(self, bloom: Any, connection: sqlite3.Connection, lookup_sql: str):
+        self._bloom = bloom
+        self._connection = connection
+        self._lookup_sql = lookup_sql
+        self._pending_keys: set[tuple] = set()
+
+    def __contains__(self, key: tuple) -> bool:
+        if key not in self._bloom:
+            return False
+        if key in self._pending_keys:
+            return True
+        return self._connection.execute(self._lookup_sql, key).fetchone() is not None
+
+    def add(self, key: tuple) -> None:
+        self._bloom.add(key)
+        self._pending_keys.add(key)
+
+    def update_stored(self, keys: Iterable[tuple]) -> None:
+        """ Add the keys of records already stored in SQLite backend, which only need the bloom filter. """
+        self._bloom.update(keys)
+
+    def clear_pending(self) -> None:
+        """ Forget the keys of pending records, after they have been written into SQLite backend. """
+        self._pending_keys.clear()
 
 
 class JsonDataCollector(object):
@@ -14,16 +134,28 @@ class JsonDataCollector(object):
     Collect sequence of Json-Like objects to structured table data.
     """
 
+    # Default PRAGMA settings applied on the SQLite connection, trading durability for insert throughput.
+    DEFAULT_PRAGMAS = {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "temp_store": "MEMORY",
+        "cache_size": -65536,
+        "mmap_size": 268435456,
+        "busy_timeout": 5000,
+    }
+
     def __init__(self,
                  collection_name: str,
                  fields: List[Field],
                  in_memory: bool = True,
                  unique_keys: List[int] = None,
-                 sorted_keys: List[List[int]] = None,
+                 sorted_keys: List[List[int | tuple[int, str]]] = None,
                  error_handler: Callable[[Exception, Any], Any] = None,
                  ignore_duplicates: bool = False,
                  append: bool = False,
-                 batch_size: int = 4096):
+                 batch_size: int = 4096,
+                 pragma_overrides: Dict[str, Any] = None,
+                 expected_rows: int = None):
         """
         Initialize a DataCollector object.
 
@@ -32,13 +164,19 @@ class JsonDataCollector(object):
                              also be used as filename of that SQLite database.
             error_handler: A callable that handle the exceptions raised. The first argument
                            is the exception raised, and the second argument is the raw record
-                           that causes this exception. If `None` is set, the record will be
+                           that causes this exception (or the parsed row `[value_1, ..., value_n]`
+                           if it cannot be written into SQLite). If `None` is set, the record will be
                            simply skipped when causing an exception.
             in_memory: Use in-memory mode for Sqlite database if True. Otherwise, use file.
             sorted_keys: A list of integer list that represents the keys to be indexed. Example:
                          specifying `sorted_keys=[[1, 2], [0]]` would create two indexes; the first
-                         one is on column (field) 1 and 2, while the second one is on column 0. To reduce
-                         the overhead of insert operation, only create indexes on necessary fields.
+                         one is on column (field) 1 and 2, while the second one is on column 0. A key can
+                         also be given as `(column, direction)`, e.g. `sorted_keys=[[(1, "ASC"), (2, "DESC")]]`,
+                         so that `ORDER BY` with that direction can be satisfied by the index. An index
+                         that is a prefix of another index (including the one on `unique_keys`) is not
+                         created, as the longer one serves it. To reduce the overhead of insert operation,
+                         only create indexes on necessary fields.
+                         For a new table, indexes are created after bulk insert (see `finalize()`).
             unique_keys: A list of integers which are the indices of columns that used for identifying
                          duplicate data. Example: `unique_keys=[0, 2, 4]` means two records would be
                          considered as the same if their fields 0, 2, and 4 are the same.
@@ -53,6 +191,15 @@ class JsonDataCollector(object):
                     records stored in the old file would be truncated before inserting new records by this
                     JsonDataCollector instance.
             fields: A list of `Field` objects that includes the fields which should be captured from raw data.
+            pragma_overrides: A dict of SQLite PRAGMA settings that overrides `DEFAULT_PRAGMAS`. Example:
+                              `pragma_overrides={"synchronous": "OFF"}` disables syncing to disk entirely,
+                              which is faster but the database may be corrupted if the OS crashes. WAL
+                              journal mode is not used when `in_memory=True`.
+            expected_rows: The expected number of records in this collection. If set (with `unique_keys` and
+                           `ignore_duplicates=True`), duplicates are detected by a bloom filter sized for
+                           `expected_rows` instead of keeping all unique keys in memory; a possible hit of the
+                           bloom filter is checked exactly by an index lookup in SQLite. It reduces memory usage
+                           for very large collections. Package `rbloom` needs to be installed.
         """
         self._sqlite: sqlite3.Connection | None = None
         self._in_memory = in_memory
@@ -62,18 +209,53 @@ class JsonDataCollector(object):
         self._collection_name = collection_name
         self._skip_duplicate = ignore_duplicates
         self._append = append
-        self._hash_keys = dict()
-        self._inc_id = 1
+        self._hash_keys: set[tuple] | _BloomKeySet = set()
+        self._expected_rows = expected_rows
+        self._use_bloom = expected_rows is not None and len(self._unique_keys) > 0 and ignore_duplicates
+        if self._use_bloom and Bloom is None:
+            raise ImportError("Package `rbloom` needs to be installed when `expected_rows` is set.")
+        self._uniq_names = ()
+        self._uniq_positions = ()
+        self._uniq_key_getter = None
         self._batch_size = batch_size
         self._error_handler = error_handler
+        self._pragmas = dict(self.DEFAULT_PRAGMAS)
+        if pragma_overrides is not None:
+            self._pragmas.update(pragma_overrides)
+        self._insert_sql = ""
+        self._deferred_indexes = []
+        self._indexes_built = False
+        self._field_names = []
+        self._quoted_names = []
+        self._columns_sql = ""
+        self._placeholders_sql = ""
+        self._parsers = []
+        self._pending = []
+        self._skipped = []
+        # The next `__id` (boxed, so that it is shared with the finalizer) for a table created by previous
+        # versions, where `__id` is not the rowid and has to be bound explicitly; None if SQLite assigns it.
+        self._legacy_next_id: List[int] | None = None
 
         self.__init_sqlite()
+        self._finalizer = weakref.finalize(self, _release_sqlite, self._sqlite, self._pending, self._skipped,
+                                           self._insert_sql, self._deferred_indexes, self._legacy_next_id,
+                                           self._uniq_key_getter, self._error_handler)
 
-    def __del__(self):
-        """ Release the resource of sqlite connection. """
-        if self._sqlite is not None:
-            self._sqlite.commit()
-            self._sqlite.close()
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self) -> None:
+        """
+        Write all pending records, create the deferred indexes, and release the resource of sqlite
+        connection. It is also called automatically when this object is garbage collected or the
+        interpreter exits.
+        """
+        if self._finalizer.alive:
+            self.finalize()
+            self._finalizer()
 
     @property
     def name(self):
@@ -110,14 +292,109 @@ class JsonDataCollector(object):
         Args:
             r: A list of record (dict-like), or a dict-like object.
         """
-        r_list = r if isinstance(r, list) else list(r)
-        for record in r_list:
-            try:
-                r_parsed = {f.name: f.parse(record) for f in self.fields}
-                self.__insert(r_parsed)
-            except Exception as e:
-                if self._error_handler is not None:
+        self.add_many([r] if isinstance(r, dict) else r)
+
+    def add_many(self, records: Iterable[dict]) -> None:
+        """
+        Add records from an iterable (e.g., a generator) into Sqlite backend. The records are consumed
+        in batches of `batch_size`, so that the iterable is never materialized as a whole.
+
+        Args:
+            records: An iterable of record (dict-like). Use `add()` for a single record.
+        """
+        if isinstance(records, dict):
+            raise TypeError("add_many() expects an iterable of records, not a single dict; use add() instead")
+        records = iter(records)
+        bad_rows = [] if self._error_handler is not None else None
+        while batch := list(itertools.islice(records, self._batch_size)):
+            ingest_batch(batch,
+                         self._parsers,
+                         self._uniq_key_getter,
+                         self._hash_keys,
+                         self._skip_duplicate,
+                         self._pending,
+                         bad_rows,
+                         self._skipped)
+            if len(self._pending) + len(self._skipped) >= self._batch_size:
+                self.flush()
+            if bad_rows:
+                for e, record in bad_rows:
                     self._error_handler(e, record)
+                bad_rows.clear()
+
+    def add_dataframe(self, df: Any) -> None:
+        """
+        Add the rows of a `pandas.DataFrame` into Sqlite backend in bulk. The DataFrame must contain
+        a column for each field (named by `Field.name`); the values are stored as they are, i.e., the
+        parsers of fields are not applied. Package `pandas` needs to be installed.
+
+        Args:
+            df: A `pandas.DataFrame` which holds the records to be added.
+        """
+        missing_columns = [name for name in self._field_names if name not in df.columns]
+        if len(missing_columns) > 0:
+            raise ValueError(f"Columns missing in the DataFrame: {', '.join(missing_columns)}")
+        frame = df[self._field_names]
+        keys = []
+        # Unique keys are only tracked when duplicates are skipped.
+        if self._uniq_key_getter is not None:
+            uniq_names = list(self._uniq_names)
+            frame = frame.drop_duplicates(subset=uniq_names)
+            keys = list(frame[uniq_names].itertuples(index=False, name=None))
+            accepted = [key not in self._hash_keys for key in keys]
+            frame = frame[accepted]
+            keys = [key for key, is_accepted in zip(keys, accepted) if is_accepted]
+        if len(frame) == 0:
+            return
+        # Keep the order of records added before.
+        self.flush()
+        if self._legacy_next_id is not None:
+            frame = frame.assign(__id=range(self._legacy_next_id[0], self._legacy_next_id[0] + len(frame)))
+        # A multi-row INSERT binds len(fields) parameters per row, which is limited by SQLite.
+        max_variables = 32766 if sqlite3.sqlite_version_info >= (3, 32, 0) else 999
+        frame.to_sql(self._collection_name,
+                     self._sqlite,
+                     if_exists="append",
+                     index=False,
+                     method="multi",
+                     chunksize=max(1, min(self._batch_size, max_variables // len(frame.columns))))
+        self._sqlite.commit()
+        if self._legacy_next_id is not None:
+            self._legacy_next_id[0] += len(frame)
+        # Only mark the keys as seen once the rows are stored.
+        if self._use_bloom:
+            self._hash_keys.update_stored(keys)
+        else:
+            self._hash_keys.update(keys)
+
+    def flush(self) -> None:
+        """
+        Write all pending records into Sqlite backend and commit them in a single transaction.
+        If the batch fails, it is rolled back and the records are written one by one instead,
+        so that only the problematic records are passed to `error_handler` (or skipped).
+        """
+        try:
+            failed_keys = _write_rows(self._sqlite, self._insert_sql, self._pending, self._skipped,
+                                      self._legacy_next_id, self._uniq_key_getter, self._error_handler)
+            # The failed records are not stored, so that their unique keys should not be treated as seen.
+            if self._use_bloom is False:
+                self._hash_keys.difference_update(failed_keys)
+            self._sqlite.commit()
+        finally:
+            self._pending.clear()
+            self._skipped.clear()
+            if self._use_bloom:
+                self._hash_keys.clear_pending()
+
+    def finalize(self) -> None:
+        """
+        Write all pending records into Sqlite backend, and create the indexes that have been deferred
+        until bulk insert finishes. It is called automatically before the first query, and on `close()`.
+        """
+        self.flush()
+        if self._indexes_built is False:
+            self.__build_indexes()
+            self._sqlite.commit()
 
     def query(self, sql: str = None, parameters: Any = None) -> List[Dict[str, Any]]:
         """
@@ -129,11 +406,27 @@ class JsonDataCollector(object):
                  all objects will be returned by using a `SELECT *` query.
             parameters: The parameters to be bound in the SQL query string.
         """
-        return self.__get_objects(sql=sql,
-                                  params=parameters,
-                                  row_factory=lambda x, y: {
-                                      k: v for k, v in zip([col[0] for col in x.description], y)
-                                  })[1]
+        columns, cursor = self.__get_objects(sql=sql, params=parameters)
+        objects = [dict(zip(columns, row)) for row in cursor]
+        cursor.close()
+        return objects
+
+    def query_iter(self, sql: str = None, parameters: Any = None) -> Iterator[Dict[str, Any]]:
+        """
+        Iterate over the collected objects with given sql query, without holding all of them in memory.
+
+        Args:
+            sql: The SQL query string to be executed. Parameters can use character `?` for binding.
+                 For more details see `https://docs.python.org/3/library/sqlite3.html`. If None is set,
+                 all objects will be returned by using a `SELECT *` query.
+            parameters: The parameters to be bound in the SQL query string.
+        """
+        columns, cursor = self.__get_objects(sql=sql, params=parameters)
+        try:
+            for row in cursor:
+                yield dict(zip(columns, row))
+        finally:
+            cursor.close()
 
     def query_as_csv(self, sql: str = None, parameters: Any = None, file_name: str = None,
                      delimiter: str = ',') -> str | None:
@@ -149,40 +442,39 @@ class JsonDataCollector(object):
                        a string if `file_name=None`.
             delimiter: The delimiter used in csv file.
         """
-
-        def __parse_val(val: Any) -> str:
-            if isinstance(val, str):
-                # Escape special characters
-                val = val.replace("\"", "\"\"")
-                return f"\"{val}\""
-            else:
-                return str(val)
-
-        columns, objects = self.__get_objects(sql, parameters, None)
-        # Header
-        csv_lines = [delimiter.join(columns)]
-        # Rows
-        for obj in objects:
-            csv_lines.append(delimiter.join(list(__parse_val(val) for val in obj)))
-        csv_str = os.linesep.join(csv_lines)
+        cursor = self.__execute(sql, parameters)
         if file_name is not None and len(file_name) > 0:
-            with open(file_name, "w+", encoding="utf-8") as fd:
-                fd.write(csv_str)
+            with open(file_name, "w", encoding="utf-8", newline="") as fd:
+                self.__write_csv(cursor, fd, delimiter)
                 fd.flush()
             return None
         else:
-            return csv_str
+            buffer = io.StringIO(newline="")
+            self.__write_csv(cursor, buffer, delimiter)
+            return buffer.getvalue()
+
+    def __write_csv(self, cursor: sqlite3.Cursor, fd: TextIO, delimiter: str) -> None:
+        """ Stream the result of the executed cursor to a text stream in csv format. """
+        writer = csv.writer(fd, delimiter=delimiter, quoting=csv.QUOTE_MINIMAL, lineterminator=os.linesep)
+        # Header
+        writer.writerow(col[0] for col in cursor.description)
+        # Rows
+        while rows := cursor.fetchmany(10000):
+            writer.writerows(rows)
+        cursor.close()
 
-    def __get_objects(self, sql: str, params: Any, row_factory: Any) -> tuple[tuple, list[Any]]:
-        """ Get objects from given sql query. """
+    def __execute(self, sql: str, params: Any) -> sqlite3.Cursor:
+        """ Execute given sql query and return the cursor. """
+        self.finalize()
         sql = sql if isinstance(sql, str) and len(sql) > 0 else f"SELECT * FROM {self._collection_name}"
-        cursor = self._sqlite.cursor()
-        cursor.row_factory = row_factory
-        cursor = cursor.execute(sql, params if params is not None else tuple())
+        return self._sqlite.execute(sql, params if params is not None else tuple())
+
+    def __get_objects(self, sql: str, params: Any) -> tuple[tuple, sqlite3.Cursor]:
+        """ Get the columns and the cursor for iterating objects (as tuples) from given sql query. """
+        cursor = self.__execute(sql, params)
+        cursor.arraysize = 4096
         res_columns = tuple(col[0] for col in cursor.description)
-        res_objects = cursor.fetchall()
-        cursor.close()
-        return res_columns, res_objects
+        return res_columns, cursor
 
     def __init_sqlite(self):
         """ Initialize the Sqlite3 backend storage """
@@ -191,104 +483,127 @@ class JsonDataCollector(object):
             self._sqlite = sqlite3.connect(":memory:")
         else:
             self._sqlite = sqlite3.connect(f"{self._collection_name}.sqlite")
+        for pragma_name, pragma_value in self._pragmas.items():
+            if self._in_memory and pragma_name == "journal_mode":
+                continue
+            self._sqlite.execute(f"PRAGMA {pragma_name}={pragma_value}")
         if self._append is False:
             self._sqlite.execute(f"DROP TABLE IF EXISTS {self._collection_name}")
         # Create __columns__
-        stmt_fields = ",".join(tuple(f"`{field.name}` {field.type}" for field in self.fields))
+        self._field_names = [field.name for field in self.fields]
+        self._quoted_names = [f"`{name}`" for name in self._field_names]
+        stmt_fields = ",".join(f"{quoted_name} {field.type}"
+                               for quoted_name, field in zip(self._quoted_names, self.fields))
         sql_collection = (f"CREATE TABLE IF NOT EXISTS {self._collection_name} "
-                          f"({stmt_fields}, __id INTEGER)")
+                          f"({stmt_fields}, __id INTEGER PRIMARY KEY AUTOINCREMENT)")
         self._sqlite.execute(sql_collection)
-        self._sqlite.execute(f"CREATE INDEX IF NOT EXISTS index_id ON {self._collection_name} (__id)")
-        if len(self._unique_keys) > 0:
-            unique_key_columns = ",".join([self.fields[uniq_key_id].name for uniq_key_id in self._unique_keys])
-            self._sqlite.execute(f"CREATE INDEX IF NOT EXISTS idx_id "
-                                 f"ON {self._collection_name} ({unique_key_columns})")
-        self._sqlite.commit()
-        # Create indexes for sorted_keys.
-        if len(self._sorted_keys) > 0:
-            for sorted_key_pair in self._sorted_keys:
-                sorted_key_index_name = "idx_sk_" + ("_".join(list(str(x) for x in sorted_key_pair)))
-                sorted_key_columns = ",".join([self.fields[sorted_key_id].name for sorted_key_id in sorted_key_pair])
-                if self._sqlite.execute(f"SELECT COUNT(1) FROM sqlite_master "
-                                        f"WHERE type='index' "
-                                        f"AND tbl_name='{self._collection_name}' "
-                                        f"AND name='{sorted_key_index_name}'").fetchone()[0] == 0:
-                    self._sqlite.execute(f"CREATE INDEX {sorted_key_index_name} "
-                                         f"ON {self._collection_name} ({sorted_key_columns})")
+        # Prepare the INSERT statement once, so that it can be reused by executemany.
+        self._parsers = [field.parse for field in self.fields]
+        self._columns_sql = ",".join(self._quoted_names)
+        self._placeholders_sql = ",".join("?" for _ in self._field_names)
+        # `__id` is an alias of rowid, and it is assigned by SQLite. A table created by previous versions
+        # keeps its plain `__id INTEGER` column, so that `__id` is bound explicitly, continuing from MAX(__id).
+        table_info = self._sqlite.execute(f"PRAGMA table_info({self._collection_name})").fetchall()
+        if any(col[1] == "__id" and col[5] > 0 for col in table_info):
+            self._insert_sql = (f"INSERT INTO {self._collection_name} ({self._columns_sql}) "
+                                f"VALUES ({self._placeholders_sql})")
+        else:
+            existing_max_id = self._sqlite.execute(f"SELECT MAX(__id) FROM {self._collection_name}").fetchone()[0]
+            self._legacy_next_id = [existing_max_id + 1 if existing_max_id is not None else 1]
+            self._insert_sql = (f"INSERT INTO {self._collection_name} (__id, {self._columns_sql}) "
+                                f"VALUES (?, {self._placeholders_sql})")
+        # Prepare indexes on unique_keys and sorted_keys.
+        index_statements = []
+        unique_key_ids = tuple(self._unique_keys)
+        for index_name, index_group in self.__canonical_index_groups():
+            index_columns = ",".join(f"{self._quoted_names[key_id]} {direction}" for key_id, direction in index_group)
+            stmt_index = (f"CREATE INDEX IF NOT EXISTS {index_name} "
+                          f"ON {self._collection_name} ({index_columns})")
+            if self._use_bloom and tuple(key_id for key_id, _ in index_group[:len(unique_key_ids)]) == unique_key_ids:
+                # Possible hits of the bloom filter are checked on this index (in any direction) during insert.
+                self._sqlite.execute(stmt_index)
+            else:
+                index_statements.append(stmt_index)
+        # For a new table, delay creating indexes until the first query (or finalize()), so that
+        # bulk insert does not need to maintain these B-trees for every record.
+        self._deferred_indexes = index_statements
+        self._indexes_built = False
+        if self._append is True:
+            self.__build_indexes()
         self._sqlite.commit()
         # Prepare in-memory hash table for fast checking duplicates.
-        self._hash_keys = dict()
-        if self._append is True:
-            cursor_existed = self._sqlite.execute(f"SELECT * FROM {self._collection_name}")
-            for rec in cursor_existed:
-                rec_hash = self.__hash_unique_key(rec)
-                # storage as [field_1, field_2, ..., field_n, #id]
-                # Here we only select value defined in unique_keys.
-                rec_keys = tuple(rec[x] for x in self._unique_keys)
-                if self._hash_keys.get(rec_hash, None) is None:
-                    self._hash_keys[rec_hash] = [rec_keys]
-                else:
-                    self._hash_keys[rec_hash].append(rec_keys)
-        # Make the auto-inc id continuous.
-        if self._append is True:
-            cursor_count = self._sqlite.execute(f"SELECT COUNT(1) FROM {self._collection_name}")
-            existing_count = cursor_count.fetchone()[0]
-            self._inc_id = existing_count + 1
+        # The tuple of values on unique_keys is used as the key directly. Keys are not tracked at all
+        # if duplicates are accepted.
+        self._uniq_names = tuple(self.fields[uniq_key_id].name for uniq_key_id in self._unique_keys)
+        self._uniq_positions = tuple(self._unique_keys)
+        if self._skip_duplicate is False:
+            self._uniq_key_getter = None
+        elif len(self._uniq_positions) == 1:
+            self._uniq_key_getter = lambda values, position=self._uniq_positions[0]: (values[position],)
+        elif len(self._uniq_positions) > 1:
+            self._uniq_key_getter = operator.itemgetter(*self._uniq_positions)
         else:
-            self._inc_id = 1
-
-    def __insert(self, r):
-        """ Insert a single record to the result set. """
-        r_hash = self.__hash_unique_key(r)
-        if self._skip_duplicate is False or self.__has_duplicate(r, r_hash) is False:
-            r_id = self._inc_id
-            # Insert into Sqlite backend.
-            columns = ",".join(list(f"`{f.name}`" for f in self.fields))
-            placeholders = ','.join(list('?' for _ in self.fields))
-            values = list(r[x.name] for x in self.fields)
-            # Assume the following SQL query will not result in syntax error
-            # (as there must be len(columns) >= 1).
-            self._sqlite.execute(
-                f"INSERT INTO {self._collection_name} (__id, {columns}) VALUES ({r_id}, {placeholders})",
-                values
-            )
-            # Update hash table
-            r_uniq_keys = tuple(r[self.fields[key_id].name] for key_id in self._unique_keys)
-            if self._hash_keys.get(r_hash, None) is None:
-                self._hash_keys[r_hash] = [r_uniq_keys]
-            else:
-                self._hash_keys[r_hash].append(r_uniq_keys)
-            # Increase the auto-increment pointer
-            self._inc_id = self._inc_id + 1
-        if self._inc_id % self._batch_size == 0:
-            self._sqlite.commit()
+            self._uniq_key_getter = None
+        if self._use_bloom:
+            lookup_conditions = " AND ".join(f"{self._quoted_names[uniq_key_id]} IS ?"
+                                             for uniq_key_id in self._uniq_positions)
+            self._hash_keys = _BloomKeySet(Bloom(self._expected_rows, 0.001),
+                                           self._sqlite,
+                                           f"SELECT 1 FROM {self._collection_name} WHERE {lookup_conditions} LIMIT 1")
+        else:
+            self._hash_keys = set()
+        if self._append is True and self._uniq_key_getter is not None:
+            # Only select the columns defined in unique_keys.
+            unique_key_columns = ",".join(self._quoted_names[uniq_key_id] for uniq_key_id in self._uniq_positions)
+            cursor_existed = self._sqlite.execute(f"SELECT {unique_key_columns} FROM {self._collection_name}")
+            cursor_existed.arraysize = 10000
+            while batch := cursor_existed.fetchmany():
+                if self._use_bloom:
+                    self._hash_keys.update_stored(batch)
+                else:
+                    self._hash_keys.update(batch)
+            cursor_existed.close()
 
-    def __has_duplicate(self, r, r_hash):
-        """ Are there any records with the same content as the given record? """
-        bucket = self._hash_keys.get(r_hash, None)
-        if bucket is None:
-            return False
-        r_uniq_keys = tuple(r[self.fields[key_id].name] for key_id in self._unique_keys)
-        for r_compared in bucket:
-            if self.__tuple_eq(r_compared, r_uniq_keys) is True:
-                return True
-        return False
-
-    def __tuple_eq(self, x: tuple, y: tuple):
-        """ Does tuple x equal to record y? """
-        for i in range(0, len(x)):
-            if x[i] != y[i]:
-                return False
-        return True
-
-    def __hash_unique_key(self, record):
-        """ Get the hash value of given record. """
-        if len(self._unique_keys) == 0:
-            raise RuntimeError("No unique key specified when hashing")
-        md5 = hashlib.md5()
-        for uniq_key_id in self._unique_keys:
-            if isinstance(record, dict):
-                md5.update(str(record[self.fields[uniq_key_id].name]).encode())
-            elif isinstance(record, tuple):
-                md5.update(str(record[uniq_key_id]).encode())
-        return md5.hexdigest()
+    def __canonical_index_groups(self) -> List[tuple[str, tuple]]:
+        """
+        Get the (name, columns) of indexes to be created, where columns are `(field index, direction)` pairs.
+        An index whose columns are a prefix of another one (or of it with every direction reversed, as SQLite
+        can scan an index backwards) is dropped, as the longer index serves it as well.
+        """
+        def __reversed_group(group: tuple) -> tuple:
+            return tuple((key_id, "DESC" if direction == "ASC" else "ASC") for key_id, direction in group)
+
+        groups = []
+        if len(self._unique_keys) > 0:
+            groups.append(("idx_id", tuple((key_id, "ASC") for key_id in self._unique_keys)))
+        for sorted_key_pair in self._sorted_keys:
+            sorted_key_group = tuple((key, "ASC") if isinstance(key, int) else (key[0], str(key[1]).upper())
+                                     for key in sorted_key_pair)
+            for key_id, direction in sorted_key_group:
+                if direction not in ("ASC", "DESC"):
+                    raise ValueError(f"Invalid direction of sorted key {key_id}: {direction} (ASC or DESC expected)")
+            sorted_key_index_name = "idx_sk_" + ("_".join(str(key_id) + ("d" if direction == "DESC" else "")
+                                                          for key_id, direction in sorted_key_group))
+            groups.append((sorted_key_index_name, sorted_key_group))
+        canonical_groups = []
+        for i, (index_name, index_group) in enumerate(groups):
+            covered = False
+            for j, (_, other_group) in enumerate(groups):
+                if i == j or len(other_group) < len(index_group):
+                    continue
+                if other_group[:len(index_group)] not in (index_group, __reversed_group(index_group)):
+                    continue
+                # Keep the longer one; for identical groups, keep the first one.
+                if len(other_group) > len(index_group) or j < i:
+                    covered = True
+                    break
+            if covered is False:
+                canonical_groups.append((index_name, index_group))
+        return canonical_groups
+
+    def __build_indexes(self):
+        """ Create the deferred indexes on the collection table. """
+        for stmt_index in self._deferred_indexes:
+            self._sqlite.execute(stmt_index)
+        self._deferred_indexes.clear()
+        self._indexes_built = True
@@ -1,5 +1,27 @@
 from typing import Callable, Any
 
+# Marks a missing attribute when walking through the record in default parser.
+_SENTINEL = object()
+
+
+def _compile_key_path(key_path: tuple) -> Callable[[Any], Any]:
+    """
+    Generate a function that gets the nested attribute on `key_path` from a record, unrolling
+    the walk on each key. `_SENTINEL` is returned if the attribute cannot be matched.
+    """
+    if len(key_path) == 1:
+        key = key_path[0]
+        return lambda r: r.get(key, _SENTINEL) if isinstance(r, dict) else _SENTINEL
+    lines = ["def get(r):"]
+    for key in key_path:
+        lines.append("    if not isinstance(r, dict):")
+        lines.append("        return _SENTINEL")
+        lines.append(f"    r = r.get({key!r}, _SENTINEL)")
+    lines.append("    return r")
+    namespace = {"_SENTINEL": _SENTINEL}
+    exec("\n".join(lines), namespace)
+    return namespace["get"]
+
 
 class Field(object):
     """
@@ -37,7 +59,8 @@ class Field(object):
         self._value_validator = value_validator
         self._value_parser = value_parser if value_parser is not None else self.default_value_parser
         self._type = None
-        self._splited_key_names = self.raw_name.split(".")
+        self._key_path = tuple(self._raw_name.split("."))
+        self._get_raw_value = _compile_key_path(self._key_path)
 
     @property
     def name(self):
@@ -68,12 +91,9 @@ class Field(object):
 
     def default_value_parser(self, record):
         """ Default value parser """
-        r = record
-        for key in self._splited_key_names:
-            if isinstance(r, dict) and key in r.keys():
-                r = r[key]
-            else:
-                return None
+        r = self._get_raw_value(record)
+        if r is _SENTINEL:
+            return None
         if self._value_validator is not None and self._value_validator(r) is False:
             raise ValueError(f"Value error when parsing field {self.name} according to configured validator: {str(r)}")
         if self._value_converter is not None: